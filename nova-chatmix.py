@@ -2,23 +2,88 @@
 
 # Licensed under the 0BSD
 
-from signal import SIGINT, SIGTERM, signal
-from subprocess import Popen, check_output
+import logging
+import os
+from functools import lru_cache
+from select import EPOLLET, EPOLLIN, epoll
+from selectors import EVENT_READ, DefaultSelector
+from signal import SIG_DFL, SIGCHLD, SIGINT, SIGTERM, signal
+from threading import Event, Lock, Thread
 
-from hid import device
 from hid import enumerate as hidenumerate
+from pulsectl import Pulse, PulseError
 
-CMD_PACTL = "pactl"
 CMD_PWLOOPBACK = "pw-loopback"
 
+log = logging.getLogger("nova")
+
+
+# HID enumeration walks /dev and udev, so cache it per (vid, pid). Call
+# _enumerate_devices.cache_clear() to rescan after a hotplug
+@lru_cache
+def _enumerate_devices(vid: int, pid: int) -> tuple:
+    return tuple(hidenumerate(vid, pid))
+
+
+# The set of distinct messages actually sent (feature toggles, volume
+# steps, presets) is small and repeated, so build each padded message once
+@lru_cache(maxsize=512)
+def _pad_msg(msg_len: int, data: tuple[int, ...]) -> bytes:
+    return bytes(data).ljust(msg_len, b"\0")
+
 
 class ChatMix:
+    # Slots make attribute access a fixed-offset lookup and drop the
+    # per-instance __dict__
+    __slots__ = (
+        "output_sink",
+        "main_sink",
+        "chat_sink",
+        "pulse",
+        "main_sink_pid",
+        "chat_sink_pid",
+        "_sink_cache",
+        "_sinks_valid",
+        "_pending",
+        "_pending_lock",
+        "_new_volumes",
+        "_stop",
+        "_worker",
+        "_closed",
+    )
+
+    # How long to wait for further dial ticks before applying the volume.
+    # Short enough to be imperceptible, long enough to coalesce a spin
+    DEBOUNCE_SECONDS = 0.015
+
     # Create virtual pipewire sinks
     def __init__(self, output_sink: str, main_sink: str, chat_sink: str):
+        self.output_sink = output_sink
         self.main_sink = main_sink
         self.chat_sink = chat_sink
-        self.main_sink_process = self._create_virtual_sink(main_sink, output_sink)
-        self.chat_sink_process = self._create_virtual_sink(chat_sink, output_sink)
+        # Persistent native connection to PipeWire/PulseAudio, so changing
+        # volume doesn't have to spawn a pactl process on every dial tick
+        self.pulse = Pulse("nova-chatmix")
+        # Sink objects cached by name, looked up lazily since the virtual
+        # sinks take a moment to appear after pw-loopback starts
+        self._sink_cache = {}
+        self.main_sink_pid, self.chat_sink_pid = self._spawn_virtual_sinks(
+            (main_sink, chat_sink), output_sink
+        )
+        # Single flag instead of polling the children with waitpid on every
+        # volume change, SIGCHLD clears it when a pw-loopback dies
+        self._sinks_valid = True
+        signal(SIGCHLD, self._on_sigchld)
+        # Volumes are applied by a dedicated worker so a slow PulseAudio
+        # can't stall the USB read loop. Only the latest pair is kept,
+        # which coalesces dial bursts on its own
+        self._pending = None
+        self._pending_lock = Lock()
+        self._new_volumes = Event()
+        self._stop = Event()
+        self._closed = False
+        self._worker = Thread(target=self._apply_loop, daemon=True)
+        self._worker.start()
 
     def set_main_volume(self, volume: int):
         self._set_volume(self.main_sink, volume)
@@ -26,16 +91,108 @@ class ChatMix:
     def set_chat_volume(self, volume: int):
         self._set_volume(self.chat_sink, volume)
 
+    # A fast dial spin produces a burst of messages where only the last
+    # value matters, so just record it and poke the worker
     def set_volumes(self, main_volume: int, chat_volume: int):
-        self.set_main_volume(main_volume)
-        self.set_chat_volume(chat_volume)
+        with self._pending_lock:
+            self._pending = (main_volume, chat_volume)
+        self._new_volumes.set()
+
+    def _apply_loop(self):
+        while not self._stop.is_set():
+            self._new_volumes.wait()
+            # Short debounce so a burst collapses into one round of calls
+            self._stop.wait(self.DEBOUNCE_SECONDS)
+            self._new_volumes.clear()
+            # Re-check after the clear, it may just have eaten the wakeup
+            # close() sent while we sat in the debounce wait
+            if self._stop.is_set():
+                break
+            # Take and clear atomically, a store slipping in between would
+            # otherwise be nulled without ever being applied
+            with self._pending_lock:
+                pending = self._pending
+                self._pending = None
+            if pending is None:
+                continue
+            # The worker has to outlive transient audio-server errors, if
+            # it died the dial would silently stop working while the
+            # process and service stayed up looking healthy
+            try:
+                self._ensure_sinks()
+                self.set_main_volume(pending[0])
+                self.set_chat_volume(pending[1])
+            except Exception:
+                log.exception("Applying volumes failed")
+
+    # Reap dead children and invalidate, the next volume flush respawns them
+    def _on_sigchld(self, signum, frame):
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if pid == self.main_sink_pid:
+                self.main_sink_pid = None
+                self._sinks_valid = False
+            elif pid == self.chat_sink_pid:
+                self.chat_sink_pid = None
+                self._sinks_valid = False
+
+    def _ensure_sinks(self):
+        if self._sinks_valid:
+            return
+        if self.main_sink_pid is None:
+            self.main_sink_pid = self._respawn_missing(self.main_sink)
+        if self.chat_sink_pid is None:
+            self.chat_sink_pid = self._respawn_missing(self.chat_sink)
+        self._sinks_valid = True
+
+    # Only spawn when the sink is really gone, a pid of None can also mean
+    # a reused leftover loopback that is still alive
+    def _respawn_missing(self, name: str):
+        self._sink_cache.pop(name, None)
+        if self._find_sink(name):
+            return None
+        return self._create_virtual_sink(name, self.output_sink)
 
     def close(self):
-        self.main_sink_process.terminate()
-        self.chat_sink_process.terminate()
+        # Guard against a second call, re-terminating reaped children would
+        # just waste SIGTERM+waitpid syscalls or hit unrelated pids
+        if self._closed:
+            return
+        self._closed = True
+        self._stop.set()
+        self._new_volumes.set()
+        self._worker.join(timeout=1)
+        signal(SIGCHLD, SIG_DFL)
+        for pid in (self.main_sink_pid, self.chat_sink_pid):
+            if pid is None:
+                continue
+            os.kill(pid, SIGTERM)
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        self.pulse.close()
+
+    # One pw-loopback per sink. A single pw-cli child can't replace these,
+    # the loopback streams live inside the pw-loopback process itself.
+    # Sinks left over from a previous unclean exit are reused (pid None)
+    # instead of spawning a duplicate loopback
+    def _spawn_virtual_sinks(self, names: tuple[str, ...], output_sink: str):
+        return tuple(
+            None if self._find_sink(name) else self._create_virtual_sink(name, output_sink)
+            for name in names
+        )
 
-    def _create_virtual_sink(self, name: str, output_sink: str) -> Popen:
-        return Popen(
+    # posix_spawn (vfork+exec) skips the full fork of the Python interpreter
+    # that subprocess.Popen can fall back to
+    def _create_virtual_sink(self, name: str, output_sink: str) -> int:
+        return os.posix_spawnp(
+            CMD_PWLOOPBACK,
             [
                 CMD_PWLOOPBACK,
                 "-P",
@@ -43,14 +200,65 @@ class ChatMix:
                 "--capture-props=media.class=Audio/Sink",
                 "-n",
                 name,
-            ]
+            ],
+            os.environ,
         )
 
+    # The pw-loopback sinks show up as "input.<name>"
+    def _find_sink(self, name: str):
+        if name not in self._sink_cache:
+            for pulse_sink in self.pulse.sink_list():
+                if pulse_sink.name == f"input.{name}":
+                    self._sink_cache[name] = pulse_sink
+                    break
+        return self._sink_cache.get(name)
+
     def _set_volume(self, sink: str, volume: int):
-        Popen([CMD_PACTL, "set-sink-volume", f"input.{sink}", f"{volume}%"])
+        try:
+            self._apply_volume(sink, volume)
+        except PulseError:
+            # Stale sink object or a restarted audio server, reconnect and
+            # retry once with a fresh connection and cache
+            self._reconnect()
+            try:
+                self._apply_volume(sink, volume)
+            except PulseError:
+                # Server still down, give up until the next dial tick
+                self._sinks_valid = False
+
+    def _apply_volume(self, sink: str, volume: int):
+        pulse_sink = self._find_sink(sink)
+        if not pulse_sink:
+            # Sink not up yet or vanished, let the next flush run
+            # _ensure_sinks (it only respawns sinks without a live child).
+            # An adopted leftover isn't our child, so no SIGCHLD fires for
+            # it, this is its only respawn trigger
+            self._sinks_valid = False
+            return
+        self.pulse.volume_set_all_chans(pulse_sink, volume / 100)
+
+    # A PipeWire/PulseAudio restart kills the persistent connection and
+    # every cached sink object with it. The baseline's pactl-per-call
+    # design self-healed across restarts, so this one has to as well
+    def _reconnect(self):
+        self._sink_cache.clear()
+        self._sinks_valid = False
+        if not self.pulse.connected:
+            self.pulse.connect()
 
 
 class NovaProWireless:
+    __slots__ = (
+        "dev",
+        "output_sink",
+        "CHATMIX_CONTROLS_ENABLED",
+        "SONAR_ICON_ENABLED",
+        "CLOSE",
+        "_wake_fd",
+        "_rx_buf",
+        "_closed",
+    )
+
     # USB IDs
     VID = 0x1038
     PID = 0x12E0
@@ -61,9 +269,6 @@ class NovaProWireless:
     # HID Message length
     MSGLEN = 63
 
-    # Message read timeout
-    READ_TIMEOUT = 1000
-
     # First byte controls data direction.
     TX = 0x6  # To base station.
     RX = 0x7  # From base station.
@@ -83,6 +288,18 @@ class NovaProWireless:
     ## EQ preset controls, 1 byte sets and shows enabled preset. Preset 4 is the custom preset required for OPT_EQ.
     OPT_EQ_PRESET = 0x2E
 
+    # Formatters for print_output, indexed by opcode. Opcodes are single
+    # bytes, so a 256-slot list makes dispatch one O(1) index
+    PRINTERS: tuple = [None] * 256
+    PRINTERS[OPT_VOLUME] = lambda msg: print(f"Volume: -{msg[2]}")
+    PRINTERS[OPT_CHATMIX] = lambda msg: print(
+        f"Game Volume: {msg[2]} - Chat Volume: {msg[3]}"
+    )
+    PRINTERS[OPT_EQ] = lambda msg: print(f"EQ: Bar: {msg[2]} - Value: {(msg[3] - 20) / 2}")
+    PRINTERS[OPT_EQ_PRESET] = lambda msg: print(f"EQ Preset: {msg[2]}")
+    # Frozen once filled, the table is never mutated after class creation
+    PRINTERS = tuple(PRINTERS)
+
     # PipeWire Names
     ## String used to automatically select output sink
     PW_OUTPUT_SINK_AUTODETECT = "SteelSeries_Arctis_Nova_Pro_Wireless"
@@ -90,13 +307,6 @@ class NovaProWireless:
     PW_GAME_SINK = "NovaGame"
     PW_CHAT_SINK = "NovaChat"
 
-    # Keeps track of enabled features for when close() is called
-    CHATMIX_CONTROLS_ENABLED = False
-    SONAR_ICON_ENABLED = False
-
-    # Stops processes when program exits
-    CLOSE = False
-
     # Device not found error string
     ERR_NOTFOUND = "Device not found"
 
@@ -104,110 +314,155 @@ class NovaProWireless:
     def __init__(self, output_sink=None):
         # Find HID device path
         devpath = None
-        for hiddev in hidenumerate(self.VID, self.PID):
+        for hiddev in _enumerate_devices(self.VID, self.PID):
             if hiddev["interface_number"] == self.INTERFACE:
                 devpath = hiddev["path"]
                 break
         if not devpath:
             raise DeviceNotFoundException
 
+        # On Linux the hidapi path is the /dev/hidraw* node, which we can
+        # read and write directly (see commands.sh). Opening it non-blocking
+        # lets a selector wait for messages instead of a blocking read
+        self.dev = os.open(devpath, os.O_RDWR | os.O_NONBLOCK)
+        # Written by close() to kick the epoll loop awake immediately
+        self._wake_fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        # Reusable RX buffer, readv fills it in place so the hot loop never
+        # allocates per packet
+        self._rx_buf = bytearray(self.MSGLEN)
+        self._closed = False
+        # Keeps track of enabled features for when close() is called
+        self.CHATMIX_CONTROLS_ENABLED = False
+        self.SONAR_ICON_ENABLED = False
+        # Stops processes when program exits
+        self.CLOSE = False
+        self.output_sink = output_sink
         # Try to automatically detect output sink, this is skipped if output_sink is given
         if not output_sink:
-            sinks = (
-                check_output([CMD_PACTL, "list", "sinks", "short"]).decode().split("\n")
-            )
-            for sink in sinks[:-1]:
-                sink_name = sink.split("\t")[1]
-                if self.PW_OUTPUT_SINK_AUTODETECT in sink_name:
-                    output_sink = sink_name
-
-        self.dev = device()
-        self.dev.open_path(devpath)
-        self.dev.set_nonblocking(True)
-        self.output_sink = output_sink
+            self._detect_output_sink()
+
+    # Looks up the headset sink by name and caches the result, so repeated
+    # calls don't query the audio server again
+    def _detect_output_sink(self) -> str:
+        if self.output_sink:
+            return self.output_sink
+        # One RPC over the native socket instead of fork+exec+parse of pactl
+        with Pulse("nova-detect") as pulse:
+            for sink in pulse.sink_list():
+                if self.PW_OUTPUT_SINK_AUTODETECT in sink.name:
+                    self.output_sink = sink.name
+                    break
+        return self.output_sink
 
     # Enables/Disables chatmix controls
     def set_chatmix_controls(self, state: bool):
-        assert self.dev, self.ERR_NOTFOUND
-        self.dev.write(
-            self._create_msgdata((self.TX, self.OPT_CHATMIX_ENABLE, int(state))),
-        )
+        assert self.dev is not None, self.ERR_NOTFOUND
+        os.write(self.dev, self._create_msgdata((self.TX, self.OPT_CHATMIX_ENABLE, int(state))))
         self.CHATMIX_CONTROLS_ENABLED = state
 
     # Enables/Disables Sonar Icon
     def set_sonar_icon(self, state: bool):
-        assert self.dev, self.ERR_NOTFOUND
-        self.dev.write(
-            self._create_msgdata((self.TX, self.OPT_SONAR_ICON, int(state))),
-        )
+        assert self.dev is not None, self.ERR_NOTFOUND
+        os.write(self.dev, self._create_msgdata((self.TX, self.OPT_SONAR_ICON, int(state))))
         self.SONAR_ICON_ENABLED = state
 
     # Sets Volume
     def set_volume(self, attenuation: int):
-        assert self.dev, self.ERR_NOTFOUND
-        self.dev.write(
-            self._create_msgdata((self.TX, self.OPT_VOLUME, attenuation)),
-        )
+        assert self.dev is not None, self.ERR_NOTFOUND
+        os.write(self.dev, self._create_msgdata((self.TX, self.OPT_VOLUME, attenuation)))
 
     # Sets EQ preset
     def set_eq_preset(self, preset: int):
-        assert self.dev, self.ERR_NOTFOUND
-        self.dev.write(
-            self._create_msgdata((self.TX, self.OPT_EQ_PRESET, preset)),
-        )
+        assert self.dev is not None, self.ERR_NOTFOUND
+        os.write(self.dev, self._create_msgdata((self.TX, self.OPT_EQ_PRESET, preset)))
 
     # ChatMix implementation
     # Continuously read from base station and ignore everything but ChatMix messages (OPT_CHATMIX)
     def chatmix_volume_control(self, chatmix: ChatMix):
-        assert self.dev, self.ERR_NOTFOUND
+        assert self.dev is not None, self.ERR_NOTFOUND
+        # Edge-triggered epoll on the device, the drain-until-EAGAIN below
+        # re-arms it. close() writes the eventfd, so SIGINT/SIGTERM wake the
+        # wait immediately instead of timing out
+        poller = epoll()
+        poller.register(self.dev, EPOLLIN | EPOLLET)
+        poller.register(self._wake_fd, EPOLLIN)
+        # Hoist the per-packet lookups to locals, LOAD_FAST is much cheaper
+        # than attribute lookups at 100+ packets/s during a dial spin
+        wait = poller.poll
+        read = os.readv
+        dev = self.dev
+        msg = self._rx_buf
+        bufs = (msg,)
+        opt_chatmix = self.OPT_CHATMIX
+        set_volumes = chatmix.set_volumes
         while not self.CLOSE:
             try:
-                msg = self.dev.read(self.MSGLEN, self.READ_TIMEOUT)
-                if not msg or msg[1] is not self.OPT_CHATMIX:
-                    continue
-
-                # 4th and 5th byte contain ChatMix data
-                gamevol = msg[2]
-                chatvol = msg[3]
-
-                # Actually change volume. Everytime you turn the dial, both volumes are set to the correct level
-                chatmix.set_volumes(gamevol, chatvol)
+                wait()
+                if self.CLOSE:
+                    break
+                # Drain everything the base station queued up
+                while True:
+                    try:
+                        length = read(dev, bufs)
+                    except BlockingIOError:
+                        break
+                    if length < 4 or msg[1] != opt_chatmix:
+                        continue
+
+                    # 4th and 5th byte contain ChatMix data
+                    gamevol = msg[2]
+                    chatvol = msg[3]
+
+                    # Actually change volume. Everytime you turn the dial, both volumes are set to the correct level
+                    set_volumes(gamevol, chatvol)
             except OSError:
                 print("Device was probably disconnected, exiting.")
                 self.CLOSE = True
+        poller.close()
         # Remove virtual sinks on exit
         chatmix.close()
 
     # Prints output from base station. `debug` argument enables raw output.
     def print_output(self, debug: bool = False):
-        assert self.dev
+        assert self.dev is not None
+        # `debug` additionally dumps the raw messages through the logger
+        if debug:
+            log.setLevel(logging.DEBUG)
+        selector = DefaultSelector()
+        selector.register(self.dev, EVENT_READ)
+        # close() writes this, so shutdown doesn't wait for the next packet
+        selector.register(self._wake_fd, EVENT_READ)
+        printers = self.PRINTERS
         while not self.CLOSE:
-            msg = self.dev.read(self.MSGLEN, self.READ_TIMEOUT)
-            if debug:
-                print(msg)
-            match msg[1]:
-                case self.OPT_VOLUME:
-                    print(f"Volume: -{msg[2]}")
-                case self.OPT_CHATMIX:
-                    print(f"Game Volume: {msg[2]} - Chat Volume: {msg[3]}")
-                case self.OPT_EQ:
-                    print(f"EQ: Bar: {msg[2]} - Value: {(msg[3] - 20) / 2}")
-                case self.OPT_EQ_PRESET:
-                    print(f"EQ Preset: {msg[2]}")
-                case _:
-                    print("Unknown Message")
+            selector.select()
+            try:
+                msg = os.read(self.dev, self.MSGLEN)
+            except BlockingIOError:
+                continue
+            log.debug("msg=%r", msg)
+            printer = printers[msg[1]]
+            if printer is not None:
+                printer(msg)
+            else:
+                print("Unknown Message")
 
     # Terminates processes and disables features
     def close(self, signum, frame):
         self.CLOSE = True
+        # A repeated signal shouldn't disable the features a second time
+        if self._closed:
+            return
+        self._closed = True
         if self.CHATMIX_CONTROLS_ENABLED:
             self.set_chatmix_controls(False)
         if self.SONAR_ICON_ENABLED:
             self.set_sonar_icon(False)
+        # Wake the epoll loop so it notices CLOSE right away
+        os.eventfd_write(self._wake_fd, 1)
 
-    # Takes a tuple of ints and turns it into bytes with the correct length padded with zeroes
+    # Takes a tuple of ints and returns the memoized zero-padded message
     def _create_msgdata(self, data: tuple[int, ...]) -> bytes:
-        return bytes(data).ljust(self.MSGLEN, b"\0")
+        return _pad_msg(self.MSGLEN, data)
 
 
 class DeviceNotFoundException(Exception):
@@ -216,6 +471,7 @@ class DeviceNotFoundException(Exception):
 
 # When run directly, just start the ChatMix implementation. (And activate the icon, just for fun)
 if __name__ == "__main__":
+    logging.basicConfig()
     try:
         nova = NovaProWireless()
         nova.set_sonar_icon(state=True)
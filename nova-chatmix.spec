@@ -8,7 +8,7 @@ URL:            https://git.dymstro.nl/Dymstro/nova-chatmix-linux
 Source0:        %{name}-%{version}.tar.gz
 
 BuildRequires:  systemd-rpm-macros
-Requires:       python3,python3-hidapi,pipewire,pulseaudio-utils
+Requires:       python3,python3-hidapi,python3-pulsectl,pipewire
 
 BuildArch:      noarch
 